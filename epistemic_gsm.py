@@ -1,9 +1,23 @@
+import os
 import re
-import random
-import json
+import queue
+import itertools
+import threading
+import multiprocessing as mp
 import numpy as np
 from datasets import load_dataset
-from typing import List, Dict, Any
+from typing import List, Any
+
+try:
+    import orjson
+
+    def _dumps(obj: Any) -> bytes:
+        return orjson.dumps(obj)
+except ImportError:  # Fall back to ujson when orjson is unavailable
+    import ujson
+
+    def _dumps(obj: Any) -> bytes:
+        return ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False).encode("utf-8")
 
 # ==========================================
 # CONFIGURATION
@@ -11,9 +25,14 @@ from typing import List, Dict, Any
 SEED = 42
 OUTPUT_FILE = "epistemic_gsm.jsonl"
 NUM_CANDIDATES = 5  # Size of the ensemble (A) per bundle
+WRITE_BUFFER = 1 << 20  # Bytes accumulated per os.write() call
+WRITE_QUEUE_SIZE = 256  # Bundles buffered between generation and the writer thread
+POOL_CHUNKSIZE = 64  # Dataset rows handed to a worker per task
 
-random.seed(SEED)
-np.random.seed(SEED)
+_ANS_RE = re.compile(r"####\s*(-?[\d,]+(?:\.\d+)?)")  # Final answer after '####'
+_NUM_RE = re.compile(r"-?\d+(?:\.\d+)?")  # Plain numeric answer, as extract_answer returns
+_STEP_RE = re.compile(r'(?<=[.!?])\s+|\n')  # Sentence/step boundaries
+_PERMS = list(itertools.permutations(range(NUM_CANDIDATES)))  # Candidate orderings
 
 class EpistemicPerturber:
     """
@@ -24,39 +43,36 @@ class EpistemicPerturber:
     @staticmethod
     def extract_answer(solution: str) -> str:
         """Extracts the numeric answer after '####'."""
-        match = re.search(r"####\s*(-?[\d,]+(?:\.\d+)?)", solution)
+        match = _ANS_RE.search(solution)
         return match.group(1).replace(',', '') if match else None
 
     @staticmethod
     def get_steps(solution: str) -> List[str]:
         """Splits reasoning into sentences/steps."""
         # Remove the final answer part
-        reasoning = solution.split("####")[0]
-        # Split by newlines or periods followed by spaces
-        steps = [s.strip() for s in re.split(r'(?<=[.!?])\s+|\n', reasoning) if s.strip()]
+        reasoning = solution.partition("####")[0]
+        # Split by newlines or periods followed by spaces, stripping each piece once
+        steps = [s for s in map(str.strip, _STEP_RE.split(reasoning)) if s]
         return steps
 
     @staticmethod
-    def generate_wrong_answer(correct_ans: str) -> str:
-        """Perturbs the numeric answer (e.g., +10%, off-by-one)."""
-        try:
-            val = float(correct_ans)
-            if val.is_integer():
-                # Random integer shift
-                offset = random.choice([-1, 1, random.randint(-10, 10)])
-                return str(int(val + offset))
-            else:
-                # Float shift
-                return f"{val * random.uniform(0.8, 1.2):.2f}"
-        except:
+    def generate_wrong_answer(correct_ans: str, offset: int, scale: float) -> str:
+        """Perturbs the numeric answer (e.g., +10%, off-by-one) by a pre-drawn offset/scale."""
+        if correct_ans is None or not _NUM_RE.fullmatch(correct_ans):
             return "0"
+        val = float(correct_ans)
+        if val.is_integer():
+            # Random integer shift
+            return str(int(val + offset))
+        else:
+            # Float shift
+            return f"{val * scale:.2f}"
 
     @staticmethod
-    def create_divergence(solution: str, steps: List[str], correct_ans: str) -> str:
+    def create_divergence(prefix: str, wrong_ans: str) -> str:
         """Class III: Keeps reasoning correct, swaps final answer."""
-        wrong_ans = EpistemicPerturber.generate_wrong_answer(correct_ans)
-        # Reconstruct valid reasoning but append wrong answer
-        return " ".join(steps) + f"\n#### {wrong_ans}"
+        # prefix is the valid joined reasoning already ending in "\n#### "
+        return prefix + wrong_ans
 
     @staticmethod
     def create_fragment(steps: List[str], start_ratio: float, end_ratio: float) -> str:
@@ -69,40 +85,60 @@ class EpistemicPerturber:
         return " ".join(fragment) + " [Truncated]"
 
     @staticmethod
-    def create_hallucination(other_solutions: List[str]) -> str:
-        """Class IV: Returns a completely irrelevant solution (Cross-Sample Pollution)."""
-        # Pick a solution from a different problem to simulate confident hallucination
-        hallucination = random.choice(other_solutions)
+    def create_hallucinations(other_solutions: List[str], picks: List[int]) -> List[str]:
+        """Class IV: Returns completely irrelevant solutions (Cross-Sample Pollution)."""
+        # Take (pre-drawn) solutions from different problems to simulate confident hallucination
+        hallucinations = [other_solutions[j] for j in picks]
         # Modify the answer to be consistent with the hallucination but wrong for the query
-        return hallucination
+        return hallucinations
 
 # ==========================================
 # BUNDLE GENERATION LOGIC
 # ==========================================
 
 class BundleFactory:
-    def __init__(self, dataset):
-        self.dataset = dataset
-        # Cache all solutions for hallucination injection
-        self.all_solutions = [x['answer'] for x in dataset]
+    def __init__(self, questions: List[str], solutions: List[str]):
+        # Plain Python columns, indexed by dataset row
+        self.questions = questions
+        # Also the pool for hallucination injection
+        self.all_solutions = solutions
+        # Parse every solution once: (steps, answer) per dataset index
+        self.parsed = [
+            (EpistemicPerturber.get_steps(a), EpistemicPerturber.extract_answer(a))
+            for a in self.all_solutions
+        ]
+        # Joined reasoning chain plus answer marker, shared by Class III and Class V
+        self.answer_prefix = [" ".join(steps) + "\n#### " for steps, _ in self.parsed]
+        # Draw the wrong-answer perturbations for every (row, candidate) slot in bulk.
+        # Slots are indexed rather than consumed, so workers stay reproducible.
+        rng = np.random.default_rng(SEED)
+        shape = (len(self.all_solutions), NUM_CANDIDATES)
+        picks = rng.integers(0, 3, size=shape)
+        shifts = rng.integers(-10, 11, size=shape)
+        # Off-by-one either way, or a random shift in [-10, 10]
+        self._int_offsets = np.where(picks == 0, -1, np.where(picks == 1, 1, shifts)).tolist()
+        self._float_scales = rng.uniform(0.8, 1.2, size=shape).tolist()
+        # Source rows for hallucinated candidates, one per (row, candidate) slot
+        self._hall_idx = rng.integers(0, len(self.all_solutions), size=shape).tolist()
+        # Candidate ordering (index into _PERMS) for shuffled classes, one per row
+        self._perm_idx = rng.integers(0, len(_PERMS), size=len(self.all_solutions)).tolist()
 
-    def create_class_i(self, idx, row) -> Dict:
+    def create_class_i(self, idx) -> bytes:
         """Class I: Redundant Correctness (At least one fully correct)."""
         candidates = []
         # 1. The Truth
-        candidates.append(row['answer'])
+        candidates.append(self.all_solutions[idx])
         # 2. A duplicate truth
-        candidates.append(row['answer'])
+        candidates.append(self.all_solutions[idx])
         # 3-5. Noise/Wrong
-        for _ in range(NUM_CANDIDATES - 2):
-            candidates.append(EpistemicPerturber.create_hallucination(self.all_solutions))
+        candidates.extend(self._hallucinations(idx, NUM_CANDIDATES - 2))
         
-        random.shuffle(candidates)
-        return self._pack(row, candidates, "Class I: Redundant Correctness")
+        candidates = self._shuffle(idx, candidates)
+        return self._pack(idx, candidates, "Class I: Redundant Correctness")
 
-    def create_class_ii(self, idx, row) -> Dict:
+    def create_class_ii(self, idx) -> bytes:
         """Class II: Complementary Fragmentation (Truth split across candidates)."""
-        steps = EpistemicPerturber.get_steps(row['answer'])
+        steps, _ = self.parsed[idx]
         candidates = []
         
         # Create overlapping fragments that cover the whole chain
@@ -114,90 +150,157 @@ class BundleFactory:
         candidates.append(EpistemicPerturber.create_fragment(steps, 0.3, 0.7))
         
         # Fill rest with noise
-        for _ in range(NUM_CANDIDATES - 3):
-            candidates.append(EpistemicPerturber.create_hallucination(self.all_solutions))
+        candidates.extend(self._hallucinations(idx, NUM_CANDIDATES - 3))
             
-        random.shuffle(candidates)
-        return self._pack(row, candidates, "Class II: Complementary Fragmentation")
+        candidates = self._shuffle(idx, candidates)
+        return self._pack(idx, candidates, "Class II: Complementary Fragmentation")
 
-    def create_class_iii(self, idx, row) -> Dict:
+    def create_class_iii(self, idx) -> bytes:
         """Class III: Reasoning-Result Divergence (Correct logic, wrong answer)."""
-        steps = EpistemicPerturber.get_steps(row['answer'])
-        ans = EpistemicPerturber.extract_answer(row['answer'])
-        candidates = []
+        prefix = self.answer_prefix[idx]
         
-        # All candidates have perfect reasoning but different WRONG answers
-        for _ in range(NUM_CANDIDATES):
-            candidates.append(EpistemicPerturber.create_divergence(row['answer'], steps, ans))
+        # All candidates share the cached reasoning but have different WRONG answers
+        candidates = [
+            EpistemicPerturber.create_divergence(prefix, self._wrong_answer(idx, k))
+            for k in range(NUM_CANDIDATES)
+        ]
             
-        return self._pack(row, candidates, "Class III: Reasoning-Result Divergence")
+        return self._pack(idx, candidates, "Class III: Reasoning-Result Divergence")
 
-    def create_class_iv(self, idx, row) -> Dict:
+    def create_class_iv(self, idx) -> bytes:
         """Class IV: Contradictory Hallucination (All wrong, high variance)."""
-        candidates = []
         # Inject solutions from completely different math problems
         # This simulates high-confidence hallucinations that are logically sound but irrelevant
-        for _ in range(NUM_CANDIDATES):
-            candidates.append(EpistemicPerturber.create_hallucination(self.all_solutions))
+        candidates = self._hallucinations(idx, NUM_CANDIDATES)
             
-        return self._pack(row, candidates, "Class IV: Contradictory Hallucination")
+        return self._pack(idx, candidates, "Class IV: Contradictory Hallucination")
 
-    def create_class_v(self, idx, row) -> Dict:
+    def create_class_v(self, idx) -> bytes:
         """Class V: False Consensus (All agree on the SAME wrong answer)."""
         candidates = []
-        ans = EpistemicPerturber.extract_answer(row['answer'])
-        wrong_ans = EpistemicPerturber.generate_wrong_answer(ans)
-        steps = EpistemicPerturber.get_steps(row['answer'])
+        wrong_ans = self._wrong_answer(idx, 0)
         
         # Generate a "False Consensus" output
-        consensus_output = " ".join(steps) + f"\n#### {wrong_ans}"
+        consensus_output = self.answer_prefix[idx] + wrong_ans
         
         for _ in range(NUM_CANDIDATES):
             candidates.append(consensus_output)
             
-        return self._pack(row, candidates, "Class V: False Consensus")
+        return self._pack(idx, candidates, "Class V: False Consensus")
+
+    def _wrong_answer(self, idx, k) -> str:
+        """Wrong answer for candidate slot k of row idx."""
+        _, ans = self.parsed[idx]
+        return EpistemicPerturber.generate_wrong_answer(
+            ans, self._int_offsets[idx][k], self._float_scales[idx][k]
+        )
+
+    def _hallucinations(self, idx, count) -> List[str]:
+        """Hallucinated solutions for the first count candidate slots of row idx."""
+        return EpistemicPerturber.create_hallucinations(self.all_solutions, self._hall_idx[idx][:count])
 
-    def _pack(self, row, candidates, label) -> Dict:
-        return {
-            "question": row['question'],
-            "ground_truth": row['answer'],
-            "candidates": candidates,
-            "epistemic_class": label
-        }
+    def _shuffle(self, idx, candidates) -> List[str]:
+        """Reorders candidates by the pre-drawn permutation of row idx."""
+        return [candidates[j] for j in _PERMS[self._perm_idx[idx]]]
+
+    def _pack(self, idx, candidates, label) -> bytes:
+        """Encodes the bundle as one JSONL line (without the newline).
+
+        Candidates often repeat the same object (the duplicated truth in Class I,
+        the consensus in Class V), so each distinct object is serialized once.
+        """
+        ground_truth = self.all_solutions[idx]
+        encoded = {id(ground_truth): _dumps(ground_truth)}
+        parts = []
+        for c in candidates:
+            enc = encoded.get(id(c))
+            if enc is None:
+                enc = encoded[id(c)] = _dumps(c)
+            parts.append(enc)
+        return b"".join((
+            b'{"question":', _dumps(self.questions[idx]),
+            b',"ground_truth":', encoded[id(ground_truth)],
+            b',"candidates":[', b",".join(parts),
+            b'],"epistemic_class":', _dumps(label), b'}',
+        ))
 
 # ==========================================
 # MAIN EXECUTION
 # ==========================================
 
+_DISPATCH = ()  # Worker-local class creators (bound to one factory), set by _init_worker
+
+def _init_worker(factory):
+    global _DISPATCH
+    _DISPATCH = (
+        factory.create_class_i,
+        factory.create_class_ii,
+        factory.create_class_iii,
+        factory.create_class_iv,
+        factory.create_class_v,
+    )
+
+def build_bundle(idx):
+    """Builds the encoded bundle for dataset row idx inside a worker process."""
+    # Cyclically assign classes to ensure balanced dataset
+    return _DISPATCH[idx % 5](idx)
+
+def _write_all(fd: int, data) -> None:
+    """Writes a bytes-like buffer to a raw file descriptor, normally in one syscall."""
+    data = memoryview(data)
+    while data:
+        data = data[os.write(fd, data):]
+
+def _writer(fd: int, q: queue.Queue, errors: List[BaseException]) -> None:
+    """Writes encoded bundles from q through a byte buffer until a None sentinel."""
+    # Each line is copied into the buffer and dropped, so no bundles are retained
+    buf = bytearray()
+    try:
+        while (line := q.get()) is not None:
+            buf += line
+            buf += b"\n"
+            if len(buf) >= WRITE_BUFFER:
+                _write_all(fd, buf)
+                buf.clear()
+        if buf:
+            _write_all(fd, buf)
+    except BaseException as e:
+        errors.append(e)
+        # Keep draining so the producer never blocks on a full queue
+        while q.get() is not None:
+            pass
+
 def main():
     print("Loading GSM8K dataset...")
     ds = load_dataset("gsm8k", "main", split="test") # Using test set for generation
-    factory = BundleFactory(ds)
+    # Fetch both columns in bulk rather than converting Arrow rows one by one
+    columns = ds.to_dict()
+    factory = BundleFactory(columns["question"], columns["answer"])
     
-    bundles = []
-    print(f"Generating bundles for {len(ds)} examples...")
+    print(f"Generating bundles for {len(ds)} examples into {OUTPUT_FILE}...")
     
-    for i, row in enumerate(ds):
-        # Cyclically assign classes to ensure balanced dataset
-        mode = i % 5
-        if mode == 0:
-            bundle = factory.create_class_i(i, row)
-        elif mode == 1:
-            bundle = factory.create_class_ii(i, row)
-        elif mode == 2:
-            bundle = factory.create_class_iii(i, row)
-        elif mode == 3:
-            bundle = factory.create_class_iv(i, row)
-        elif mode == 4:
-            bundle = factory.create_class_v(i, row)
-            
-        bundles.append(bundle)
-
-    # Save to JSONL
-    print(f"Saving {len(bundles)} bundles to {OUTPUT_FILE}...")
-    with open(OUTPUT_FILE, 'w') as f:
-        for b in bundles:
-            f.write(json.dumps(b) + "\n")
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0)
+    fd = os.open(OUTPUT_FILE, flags, 0o644)
+    q = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+    errors = []
+    try:
+        # The factory is broadcast once per worker instead of pickled per task
+        with mp.Pool(os.cpu_count(), initializer=_init_worker, initargs=(factory,)) as pool:
+            # Writes run on a background thread while bundles keep arriving.
+            # It starts only once the workers exist, so none is forked from a threaded parent.
+            writer = threading.Thread(target=_writer, args=(fd, q, errors), daemon=True)
+            writer.start()
+            try:
+                # imap yields in dataset order, so the JSONL keeps the dataset order
+                for line in pool.imap(build_bundle, range(len(ds)), chunksize=POOL_CHUNKSIZE):
+                    q.put(line)
+            finally:
+                q.put(None)
+                writer.join()
+    finally:
+        os.close(fd)
+    if errors:
+        raise errors[0]
             
     print("Done! Dataset ready for GitHub.")
 